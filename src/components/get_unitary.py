@@ -1,11 +1,13 @@
 # Get unitary matrix for a given gate
-from qiskit import QuantumCircuit, transpile, BasicAer
+import numpy as np
+from qiskit import QuantumCircuit
+from qiskit.quantum_info import Operator
 
-def get_unitary(qc, backend=BasicAer.get_backend('unitary_simulator'), nd=3):
-    """Recieves a quantum circuit and returns its associated unitary matrix"""
-    if not isinstance(qc, QuantumCircuit()):
+def get_unitary(qc, nd=3):
+    """Recieves a quantum circuit and returns its associated unitary matrix,
+       rounded to nd decimals. The matrix is built directly by Operator,
+       without transpiling or running a simulator job."""
+    if not isinstance(qc, QuantumCircuit):
         raise TypeError('expecting type QuantumCircuit')
     else:
-        job = backend.run(transpile(qc, backend))
-        return job.result().get_unitary(qc, decimals=nd)
-
+        return np.round(Operator(qc).data, nd)
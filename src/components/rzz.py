@@ -1,5 +1,22 @@
 #--- Build and Return ZZ Rotation Gate ---#
-def get_rzz():
+import numpy as np
+from math import pi
+from functools import lru_cache
+from qiskit import QuantumCircuit, QuantumRegister
+from qiskit.circuit.library import SdgGate
+from qiskit.extensions import UnitaryGate
+
+#--- Define Gates ---#
+# closed form of YGate().power(1/2), hard-coded so the matrix power is not
+# recomputed; the gates are module-level so their decompositions are cached
+SY_MATRIX = 0.5 * np.array([[1+1j, -1-1j],
+                            [1+1j,  1+1j]])
+SY    = UnitaryGate(SY_MATRIX,          label=r'$\sqrt{Y}$')          # Square Root of Y Gate
+SYDG  = UnitaryGate(SY_MATRIX.conj().T, label=r'$\sqrt{Y}^\dagger$')  # SY Gate Adjoint
+SDG   = SdgGate()                                                    # S Gate Adjoint
+
+@lru_cache(maxsize=None)
+def _build_rzz():
     qr_zz = QuantumRegister(2, 'qc_zz')
     qc_zz = QuantumCircuit(qr_zz)
     qc_zz.append(SDG,[0])
@@ -9,5 +26,8 @@ def get_rzz():
     qc_zz.append(SYDG,[1])
     # add a global phase to correct for global phase introduced
     qc_zz.global_phase += pi/4
-    return qc_rzz
+    return qc_zz
 
+def get_rzz():
+    # the circuit is built once; return a copy so callers can modify it
+    return _build_rzz().copy()
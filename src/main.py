@@ -61,10 +61,8 @@ n = 14
 #--- Define Gates ---#
 RX_h  = RXGate(theta_h)    # RX(theta h) Gate
 RX_h.label  = r'$RX_h$'
-SY    = YGate().power(1/2) # Square Root of Y Gate
-SY.label    = r'$\sqrt{Y}$'
-SYDG  = SY.adjoint()       # SY Gate Adjoint
-SYDG.label  = r'$\sqrt{Y}^\dagger$'
-SDG   = SdgGate()          # S Gate Adjoint
+SY    = rzz.SY             # Square Root of Y Gate (hard-coded unitary)
+SYDG  = rzz.SYDG           # SY Gate Adjoint
+SDG   = rzz.SDG            # S Gate Adjoint
 
 
@@ -5,37 +5,97 @@
 ###  Last Modified: July 27, 2023  ###
 ######################################
 
+import numpy as np
+from   numba import njit
+
 
 #==== Define a function to create bins =======================#
 def create_bins(lower_bound, width, quantity):
     """ create_bins returns an equal-width (distance) partitioning. 
-        It returns an ascending list of tuples, representing the intervals.
-        A tuple bins[i], i.e. (bins[i][0], bins[i][1])  with i > 0 
+        It returns an ascending (quantity, 2) array, representing the intervals.
+        A row bins[i], i.e. (bins[i,0], bins[i,1])  with i > 0 
         and i < quantity, satisfies the following conditions:
-            (1) bins[i][0] + width == bins[i][1]
-            (2) bins[i-1][0] + width == bins[i][0] and
-                bins[i-1][1] + width == bins[i][1]
+            (1) bins[i,0] + width == bins[i,1]
+            (2) bins[i-1,0] + width == bins[i,0] and
+                bins[i-1,1] + width == bins[i,1]
+        It is a thin wrapper around create_bin_edges, so both share
+        exactly the same edge values; prefer the edges (e.g. with
+        pd.IntervalIndex.from_breaks) when intervals are not needed.
     """
-    bins    = []                                              # initialize array to store bins in 
-    low_arr = []                                              # initialize array of lowest values in each interval
-    count   = lower_bound                                     # initialize counter at given lower bound of bins
-    for i in range(quantity):                                 # for loop through number of bins
-       low_arr.append(count)                                  # add counter value to array of lowest values per interval
-       bins.append((low_arr[i], low_arr[i]+width))            # add new bin to array of bins
-       count = count + width                                  # increment counter so the lowest value of the next bin is count+width
+    edges      = create_bin_edges(lower_bound, width, quantity)  # get the quantity+1 bin edges
+    bins       = np.empty((quantity, 2), dtype=np.float64)    # initialize array to store bins in
+    bins[:, 0] = edges[:-1]                                   # lower bound of each bin
+    bins[:, 1] = edges[1:]                                    # upper bound of each bin
     return bins                                               # return array of bins
 
 
+#==== Define a function to create bin edges ==================#
+@njit(cache=True)
+def create_bin_edges(lower_bound, width, quantity):
+    """ create_bin_edges returns the quantity+1 ascending edges of the
+        bins of create_bins(lower_bound, width, quantity), i.e. 
+        edges[i] == bins[i,0] and edges[i+1] == bins[i,1]; e.g. for
+        pd.IntervalIndex.from_breaks. Compiled with numba.
+    """
+    edges = np.empty(quantity + 1)                            # initialize array to store edges in
+    for i in range(quantity + 1):                             # for loop through number of edges
+        edges[i] = lower_bound + i * width                    # edge i is i widths above the lower bound
+    return edges                                              # return array of edges
+
+
 #==== Define a function to put values in bins ================#
 def find_bin(value, bins):
-    """ bins is a list of tuples, like [(0,20), (20, 40), (40, 60)],
+    """ bins is a (quantity, 2) array, like [[0,20], [20, 40], [40, 60]],
         binning returns the smallest index i of bins so that
-        bin[i][0] <= value < bin[i][1]
+        bin[i,0] <= value < bin[i,1]
+        The bins are ascending, so the candidate bin is found with a
+        binary search over the lower bounds instead of a linear scan.
     """
-    for i in range(0, len(bins)):                             # for bin in range (number of bins)
-        if bins[i][0] <= value < bins[i][1]:                  # if the value is within the bounds of this bin
-            return i                                          # return bin index
+    bins = np.asarray(bins)                                   # convert bins to array (no copy if already one)
+    i    = np.searchsorted(bins[:,0], value, side='right') - 1  # index of last bin with lower bound <= value
+    if i >= 0 and value < bins[i,1]:                          # if the value is within the bounds of this bin
+        return int(i)                                         # return bin index
     return -1                                                 # otherwise, return false
 
 
+#==== Define a function to put a value in uniform bins =======#
+def find_bin_uniform(value, lower_bound, width, quantity):
+    """ For bins created by create_bins(lower_bound, width, quantity),
+        find_bin_uniform returns the same index as find_bin, but computes
+        it directly as floor((value - lower_bound) / width) instead of
+        scanning the bins. Returns -1 if value is outside of the bins.
+        The index is computed exactly as in find_bins and bin_accumulate
+        (true division, then floor), so all three agree at bin edges.
+    """
+    i = int(np.floor((value - lower_bound) / width))          # compute bin index directly from uniform width
+    if 0 <= i < quantity:                                     # if the index is within the range of bins
+        return i                                              # return bin index
+    return -1                                                 # otherwise, return false
 
+
+#==== Define a function to put an array of values in bins ====#
+def find_bins(values, lower_bound, width, quantity):
+    """ Vectorized find_bin_uniform: returns an integer array holding
+        the bin index of each entry of values, or -1 for entries
+        outside of the bins.
+    """
+    values = np.asarray(values)                               # convert values to array (no copy if already one)
+    idx    = np.floor((values - lower_bound) / width)         # compute bin index of every value at once (as bin_accumulate)
+    idx    = np.clip(idx, -1, quantity).astype(np.int64)      # clip before cast so huge values cannot overflow
+    return np.where((idx >= 0) & (idx < quantity), idx, -1)   # mark out-of-range values with -1
+
+
+#==== Define a function to count values in uniform bins ======#
+@njit(cache=True)
+def bin_accumulate(values, lower_bound, width, counts):
+    """ Adds to counts[i] the number of values falling in the i-th bin
+        of create_bins(lower_bound, width, len(counts)); values outside
+        of the bins are ignored. counts is updated in-place and returned.
+        Compiled with numba, so values must be a float array.
+    """
+    quantity = counts.shape[0]                                # number of bins
+    for v in values:                                          # for value in array of values
+        i = int(np.floor((v - lower_bound) / width))          # compute bin index directly from uniform width
+        if 0 <= i < quantity:                                 # if the index is within the range of bins
+            counts[i] += 1                                    # count value in its bin
+    return counts                                             # return array of counts
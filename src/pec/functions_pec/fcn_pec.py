@@ -1,18 +1,43 @@
-import random 
-import statistics
-import numpy       as     np
-import pandas      as     pd
-import matplotlib  as     mpl
-from   collections import Counter
-
-import qiskit_aer.noise           as      noise
-from   qiskit.providers.aer.noise import (NoiseModel, depolarizing_error)
+import hashlib
+import numpy        as    np
+import scipy.sparse as    sp
+from   functools    import lru_cache
+from   numba        import njit
+
+from   qiskit_aer.noise           import (NoiseModel, depolarizing_error)
 from   qiskit_aer                 import  AerSimulator
-from   qiskit.quantum_info        import (Statevector, DensityMatrix)
-from   qiskit.circuit.library     import (IGate, XGate, YGate, ZGate, HGate, TGate, SGate, CXGate)
-from   qiskit.visualization       import (circuit_drawer, plot_histogram)
-from   qiskit.result              import  Result
-from   qiskit                     import (QuantumCircuit, ClassicalRegister, QuantumRegister, transpile, BasicAer, Aer, execute)
+from   qiskit.quantum_info        import  Statevector
+from   qiskit                     import (QuantumCircuit, QuantumRegister, transpile)
+from   qiskit.circuit.library     import (IGate, XGate, YGate, ZGate)
+
+
+#==== Pauli gates applied by Pauli frames (0: I, 1: X, 2: Y, 3: Z) #
+PAULI_GATES = [IGate(), XGate(), YGate(), ZGate()]
+
+
+#==== Define function to calculate log of simulation overhead #
+def calc_log_sim_overhead(n, d, epsilon):
+    """
+    Define a function to calculate the natural log of the simulation overhead (log gamma_{beta}).
+    Simulation overhead depends on:
+        - n        (number of qubits)
+        - d        (circuit depth; that is, number of layers of the circuit)
+        - epsilon  (error rate)
+    Each argument can be a scalar or an array; arrays are broadcast, so a whole parameter sweep is computed at once.
+    The log of each overhead ratio (numerator / denominator) and the exponents are calculated individually.
+    The overhead of single qubit gates and for cnots are calculated individually, in the log domain, 
+    so large exponents n*d cannot overflow the intermediate powers.
+    The log stays finite even where gamma_b itself exceeds the float range, e.g. to compare overheads of large sweeps.
+    The output of the function is log(gamma_b) (a scalar for scalar arguments).
+    """
+    n, d, epsilon = map(np.asarray, (n, d, epsilon))        # coerce arguments to (possibly 0-d) arrays
+    log_den   = np.log1p(-epsilon)                          # calc   log of denominator (same for both terms) 
+    log_r1    = np.log1p(epsilon / 2) - log_den             # calc   log of 1-qubit overhead ratio
+    log_r2    = np.log1p((7 * epsilon) / 8) - log_den       # calc   log of CNOT    overhead ratio
+    exp1      = (n * d) / 2                                 # calc   exponent  of 1-qubit term (total number of 1-qubit gates)
+    exp2      = (n * d) / 4                                 # calc   exponent  of CNOT    term (total number of CNOT    gates)
+    log_gb    = exp1 * log_r1 + exp2 * log_r2               # calc   log of total simulation overhead of circuit
+    return log_gb[()]                                       # return log of total simulation overhead (0-d array -> scalar)
 
 
 #==== Define function to calculate simulation overhead =====#
@@ -23,56 +48,166 @@ def calc_sim_overhead(n, d, epsilon):
         - n        (number of qubits)
         - d        (circuit depth; that is, number of layers of the circuit)
         - epsilon  (error rate)
-    The numerators, the denominator, and the exponents are calculated individually.
-    The overhead of single qubit gates and for cnots are calculated individually.
-    The overall simulation overhead is calculated from these components.
-    The output of the function is the simulation overhead, gamma_b.
-    """
-    denom     = 1 - epsilon                                 # calc   denominator (same for both terms) 
-    num1      = 1 + ( epsilon / 2 )                         # calc   numerator of 1-qubit overhead term
-    num2      = 1 + ( (7 * epsilon) / 8 )                   # calc   numerator of CNOT    overhead term
-    exp1      = (n * d) / 2                                 # calc   exponent  of 1-qubit term (total number of 1-qubit gates)
-    exp2      = (n * d) / 4                                 # calc   exponent  of CNOT    term (total number of CNOT    gates)
-    single_gb = (num1 / denom) ** exp1                      # calc   simulation overhead for all 1-qubit gates
-    cnot_gb   = (num2 / denom) ** exp2                      # calc   simulation overhead for all CNOT    gates
-    gamma_b   = single_gb * cnot_gb                         # calc   total simulation overhead of circuit (gamma_{beta})
-    return gamma_b                                          # return total simulation overhead of circuit (gamma_{beta})
+    The overhead is computed in the log domain by calc_log_sim_overhead (one exp and a few log1p, no large powers).
+    The output of the function is the simulation overhead, gamma_b (a scalar for scalar arguments).
+    """
+    gamma_b   = np.exp(calc_log_sim_overhead(n, d, epsilon))  # calc total simulation overhead of circuit (gamma_{beta})
+    return gamma_b[()]                                      # return total simulation overhead (0-d array -> scalar)
+
+
+#==== Define function to count the noisy gates of a circuit =#
+def count_noisy_gates(n, d):
+    """
+    Define a function to count the gates of get_qc_ub that are followed by a depolarizing channel.
+    This function depends on:
+        - n  (number of qubits)
+        - d  (circuit depth; that is, number of layers of the circuit)
+    The d//2 odd layers hold n single-qubit gates each, the (d+1)//2 even layers hold n//2 CNOTs each.
+    The output of the function is the tuple (num_1q, num_cx) of exact gate counts.
+    """
+    return n*(d//2), (n//2)*((d+1)//2)                      # return number of single-qubit gates and of CNOTs
+
+
+#==== Define function to calculate PEC overhead of a circuit #
+def calc_pec_overhead(n, d, epsilon):
+    """
+    Define a function to calculate the PEC overhead of one circuit of get_qc_ub, the norm used to rescale PEC samples.
+    This depends on:
+        - n, d     (number of qubits, circuit depth; see get_qc_ub)
+        - epsilon  (error rate)
+    Unlike calc_sim_overhead (the asymptotic overhead, with n*d/2 and n*d/4 gates), the per-gate factors
+    (1 + epsilon/2)/(1 - epsilon) and (1 + 7 epsilon/8)/(1 - epsilon) are raised to the exact gate counts
+    of count_noisy_gates, which differ from n*d/2 and n*d/4 when n or d is odd.
+    The output of the function is the PEC overhead of the circuit (a scalar for scalar arguments).
+    """
+    num_1q, num_cx = count_noisy_gates(n, d)                # exact number of single-qubit gates and of CNOTs
+    log_den   = np.log1p(-epsilon)                          # calc   log of denominator (same for both terms)
+    log_r1    = np.log1p(epsilon / 2) - log_den             # calc   log of 1-qubit overhead ratio
+    log_r2    = np.log1p((7 * epsilon) / 8) - log_den       # calc   log of CNOT    overhead ratio
+    return np.exp(num_1q * log_r1 + num_cx * log_r2)[()]    # return PEC overhead (0-d array -> scalar)
+
+
+#==== Define function to pre-sample random circuit choices ==#
+def sample_qc_ub(M, n, d, num_gates, seed=None):
+    """
+    Define a function to draw the random choices for M circuits built by get_qc_ub at once.
+    This function depends on:
+        - M          (number of circuits to sample)
+        - n          (number of qubits)
+        - d          (circuit depth; that is, number of layers of the circuit)
+        - num_gates  (number of single-qubit gates to choose from)
+        - seed       (seed or Generator for the NumPy RNG)
+    Gate indices are drawn for the d//2 odd layers, qubit permutations for the (d+1)//2 even layers.
+    The output of the function is the tuple (gate_idx, perm_idx), of shapes (M, d//2, n) and (M, (d+1)//2, n).
+    """
+    rng      = np.random.default_rng(seed)                  # get NumPy RNG (reuses seed if already a Generator)
+    gate_idx = rng.integers(0, num_gates, size=(M, d//2, n))  # draw single-qubit gate indices for all odd layers
+    perm_idx = np.broadcast_to(np.arange(n), (M, (d+1)//2, n))  # list from 0:n for every even layer (no copy)
+    perm_idx = rng.permuted(perm_idx, axis=-1)              # randomly shuffle (a copy of) every list from 0:n at once
+    return gate_idx, perm_idx                               # return the random choices for all M circuits
+
+
+#==== Define function to generate a specialized circuit builder #
+@lru_cache(maxsize=None)
+def get_qc_ub_builder(n, d, barriers=False, frames=False):
+    """
+    Define a function to generate the body of get_qc_ub, specialized for fixed n and d.
+    The layer and qubit loops are unrolled into straight-line code with n, d, and all indices as constants,
+    so only the pre-sampled random choices are left as arguments. Builders are cached per (n, d, barriers, frames).
+    If frames is True, the Pauli f[layer][qubit] (if not the identity) is applied to each qubit after each layer.
+    If barriers is True, a barrier is applied after each layer.
+    Each CNOT layer is composed from the prebuilt layer template of get_cx_layer_template, relabelled by the
+    layer's qubit permutation, instead of broadcasting the n//2 CNOTs one by one.
+    The output of this function is the builder build(append, compose, barrier, single_gates, cx_layer, g, p, paulis, f), 
+    where g, p, and f are the nested-list forms of gate_idx, perm_idx, and pauli_frame (see get_qc_ub).
+    """
+    lines = ['def build(append, compose, barrier, single_gates, cx_layer, g, p, paulis, f):']
+    for layer in range(d):                                  # unroll all circuit layers
+        if layer%2 != 0:                                    # odd layer: single qubit gates
+            for qubit in range(n):                          # one append per qubit, indices as constants
+                lines.append(f'    append(single_gates[g[{layer//2}][{qubit}]], [{qubit}])')
+        else:                                               # even layer: cnot gates
+            lines.append(f'    compose(cx_layer, qubits=p[{layer//2}], inplace=True)')  # template on permuted qubits
+        if frames:                                          # Pauli corrections of this layer (PEC)
+            for qubit in range(n):
+                lines.append(f'    if f[{layer}][{qubit}]: append(paulis[f[{layer}][{qubit}]], [{qubit}])')
+        if barriers:
+            lines.append('    barrier()')                   # add barrier at end of layer
+    if d == 0:                                              # empty circuit: builder has nothing to do
+        lines.append('    pass')
+    namespace = {}                                          # namespace to define generated builder in
+    exec('\n'.join(lines), namespace)                       # compile generated source
+    return namespace['build']                               # return the specialized builder
+
+
+#==== Define function to get the template of a CNOT layer ==#
+@lru_cache(maxsize=None)
+def get_cx_layer_template(n):
+    """
+    Define a function to obtain the template of an even (CNOT) layer of get_qc_ub on n qubits:
+    qubit k controls a CNOT on qubit n//2 + k, for k < n//2 (for odd n, the last qubit idles).
+    Composed onto the qubits of a random permutation, qubit perm[k] thus controls a CNOT on perm[n//2 + k].
+    The template is built once per n and shared; compose() copies its instructions, so it is never modified.
+    """
+    half     = n//2                                         # number of CNOTs per layer
+    cx_layer = QuantumCircuit(n)                            # create template circuit
+    cx_layer.cx(list(range(half)), list(range(half, 2*half)))  # apply the n//2 disjoint CNOTs
+    return cx_layer                                         # return CNOT layer template
+
+
+#==== Define function to convert choices to nested lists ===#
+def as_nested_list(arr):
+    """
+    Define a function to obtain the nested-list form of an array of random choices, as used by the circuit builders.
+    Lists are returned as they are, so callers building many circuits can convert shared choices once, up front.
+    """
+    return arr if isinstance(arr, list) else np.asarray(arr).tolist()
 
 
 #==== Define function to create the quantum circuit ========#
-def get_qc_ub(n, d, single_gates, drawstyle='none', filename='qc'):
+def get_qc_ub(n, d, single_gates, drawstyle='none', filename='qc', gate_idx=None, perm_idx=None, barriers=False,
+              paulis=None, pauli_frame=None):
     """
     Define a function to create the quantum circuit.
     This function depends on:
         - n             (number of qubits)
         - d             (circuit depth; that is, number of layers of the circuit)
         - single_gates  (set of single-qubit gates to be randomly applied on alternating circuit layers)
+        - gate_idx      (optional (d//2, n) indices into single_gates, one row per odd layer; array or nested list)
+        - perm_idx      (optional ((d+1)//2, n) qubit permutations, one row per even layer; array or nested list)
+        - barriers      (optional; apply a barrier after each layer)
+        - paulis        (optional list of Pauli gates [I, X, Y, Z], indexed by pauli_frame; PAULI_GATES by default)
+        - pauli_frame   (optional (d, n) indices into paulis, the Pauli applied to each qubit after each layer)
     For every odd-numbered layer, random single-qubit gates from the given list are applied to each qubit.
     For every even-numbered layer, CNOTs are applied to pairs of qubits. 
         - Note: Control and target qubits are chosen randomly.
-    After each layer, a barrier is applied for readability. 
-    Each layer will thus have eiter n single-qubit gates or n/2 CNOTs.
+    If gate_idx and perm_idx are not given, they are drawn here with sample_qc_ub.
+    If barriers is True, a barrier is applied after each layer; by default they are left out, since they only 
+    add instructions to simulate (and block gate fusion). The diagram saved for drawstyle is always drawn from
+    a separate display copy with barriers (qc_display), so the returned circuit is unaffected by drawing.
+    Each layer will thus have eiter n single-qubit gates or n//2 CNOTs (for odd n, one random qubit idles).
+    If pauli_frame is given (see sample_pec_frames), each layer is followed by its non-identity Paulis.
     The output of the function is the resultant quantum circuit.
     """
+    if gate_idx is None or perm_idx is None:                # draw random choices if not pre-sampled by caller
+        gate_idx, perm_idx = sample_qc_ub(1, n, d, len(single_gates))
+        gate_idx, perm_idx = gate_idx[0], perm_idx[0]
     qr = QuantumRegister(n, 'qr')                           # create quantum register 
     qc = QuantumCircuit(qr)                                 # create quantum circuit
-    qi = list(range(n))                                     # list from 0:n
-    for layer in range(d):                                  # loop through all circuit layers (for layer in (layers))
-        if layer%2 != 0:                                    # odd layer: single qubit gates
-            for qubit in range(n):                          # add random single qubit gates from list to each qubit
-                qc.append(random.choice(single_gates), [qubit])  
-            qc.barrier()                                    # add barrier at end of layer 
-        else:                                               # even layer: cnot gates
-            random.shuffle(qi)                              # randomly shuffle list from 0:n
-            ctrl = qi[:int(n/2)]                            # second half of randomly shuffled qubits is ctrl   qubits
-            test = qi[int(n/2):]                            # first  half of randomly shuffled qubits is target qubits
-            qc.cx(ctrl, test)                               # apply CNOT (cx) gate to all ctrl-test pairs
-            qc.barrier()                                    # add barrier at end of layer 
+    frames = pauli_frame is not None                        # whether Pauli corrections are applied
+    if paulis is None: paulis = PAULI_GATES                 # apply actual Pauli gates unless given others
+    build  = get_qc_ub_builder(n, d, barriers, frames)      # get builder specialized for (n, d) (cached)
+    build(qc.append, qc.compose, qc.barrier, single_gates, get_cx_layer_template(n),
+          as_nested_list(gate_idx), as_nested_list(perm_idx), paulis,
+          as_nested_list(pauli_frame) if frames else None)  # apply all layers
     #==== Save circuit diagram to file if applicable =======#
-    if   drawstyle=='latex_source': qc.draw('latex_source', filename='./'+filename+'.tex') 
-    elif drawstyle=='mpl':          qc.draw('mpl',          filename='./'+filename+'.png') 
-    elif drawstyle=='txt':          qc.draw('text',         filename='./'+filename+'.txt') 
-    elif drawstyle=='latex':        qc.draw('latex',        filename='./'+filename+'.pdf') 
+    if drawstyle != 'none':                                 # build display copy with barriers between layers
+        qc_display = qc if barriers else get_qc_ub(n, d, single_gates, gate_idx=gate_idx, perm_idx=perm_idx,
+                                                   barriers=True, paulis=paulis, pauli_frame=pauli_frame)
+    if   drawstyle=='latex_source': qc_display.draw('latex_source', filename='./'+filename+'.tex') 
+    elif drawstyle=='mpl':          qc_display.draw('mpl',          filename='./'+filename+'.png') 
+    elif drawstyle=='txt':          qc_display.draw('text',         filename='./'+filename+'.txt') 
+    elif drawstyle=='latex':        qc_display.draw('latex',        filename='./'+filename+'.pdf') 
     return qc                                               # return the final quantum circuit
 
 
@@ -99,63 +234,740 @@ def get_dk_noise(one_q_gates, two_q_gates, epsilon):
 
 
 #==== Define function to get projector onto basis states with probabilities above the median value =============#
-def get_projector_geq_median(psi):
+def get_projector_geq_median(psi, probs=None):
     """
     Define a function to obtain projector operator projecting onto basis states with probability above the median.
     This projector depends on one argument: psi (statevector).
+        - probs can optionally pass the probabilities of psi (see get_state_probs) if the caller has already computed them.
     The probabilities are extracted from psi; the median value is extracted from psi. 
-    A list is created to store 1s and 0s associated with the probabilities for each state.
-    If the probability associated with a state is above or equal the median value, a 1 is added to a list.
-    If the probability associated with a state is below the median value, a 0 is added to a list. 
-    A new statevector is created from the resultant list, and the statevector is converted to an operator.
-    The output of this function is that operator, which projects onto the selected subset of basis states.
+    A boolean array is created to store 1s and 0s associated with the probabilities for each state.
+    If the probability associated with a state is above or equal the median value, the array holds a 1 (True).
+    If the probability associated with a state is below the median value, the array holds a 0 (False). 
+    The projector is diagonal in the computational basis, so it is represented by that array (its diagonal) 
+    instead of a dense 2^n x 2^n operator; use eval_observables() to evaluate it.
+    The output of this function is that 1-D mask, which projects onto the selected subset of basis states.
+    """
+    if probs is None:                                         # compute probabilities only if not given by caller
+        probs  = get_state_probs(psi)                         # get probabilities array from input statevector psi
+    probs      = np.asarray(probs)                            # make sure probabilities are an ndarray (no copy if already)
+    k          = probs.size // 2                              # index of (upper) median in sorted probabilities array
+    median     = np.partition(probs, k)[k]                    # identify median value of probabilities array in O(2^n)
+    mask       = np.greater_equal(probs, median)              # True for basis states w/ prob >= median (branchless compare)
+    return mask                                               # return the diagonal of the resultant projector
+
+
+
+#==== Define function to get expectation value of a diagonal projector from probabilities ======================#
+def expval_diag(probs, mask):
+    """
+    Define a function to obtain the expectation value of an observable which is diagonal in the computational basis.
+    This depends on:
+        - probs  (probabilities of the basis states, e.g. get_state_probs(psi))
+        - mask   (diagonal of the observable; a boolean mask as returned by get_projector_geq_median, or weights)
+    For a boolean mask, <psi|A|psi> is the sum of the probabilities of the selected basis states, summed in place
+    without converting the mask to floats; other diagonals are weighted with a dot product.
+    The output of this function is the (real) expectation value.
+    """
+    if mask.dtype == np.bool_:                                # projector: sum selected probabilities
+        return float(np.sum(probs, where=mask))
+    return float(np.dot(probs, mask))                         # general diagonal observable: weighted sum
+
+
+#==== Define function to get the median projector as a sparse operator ========================================#
+def get_projector_sparse(mask):
+    """
+    Define a function to obtain the projector given by its diagonal mask (see get_projector_geq_median) as an operator.
+    The projector is stored as a sparse diagonal (DIA) matrix: O(2^n) memory, where the dense operator would take O(4^n).
+    The output of this function is the sparse projector, which eval_observables() also accepts.
+    """
+    return sp.diags(mask.astype(np.float64), format='dia')    # return sparse diagonal projector
+
+
+#==== Define function to get the probabilities of the basis states of a state ==================================#
+def get_state_probs(psi):
+    """
+    Define a function to obtain the probabilities of the computational basis states of a state.
+    This depends on: psi (statevector, or density matrix).
+    For a density matrix they are the real diagonal; for a statevector they are |amplitude|^2, computed as real^2 + imag^2.
+    The output of this function is the 1-D array of probabilities.
+    """
+    data = np.asarray(psi.data)                               # get state data
+    if data.ndim == 2:
+        return np.real(np.diagonal(data))                     # probabilities are the diagonal of rho
+    vec  = data.ravel()                                       # flatten amplitudes
+    return vec.real**2 + vec.imag**2                          # probabilities are squared magnitudes of amplitudes
+
+
+#==== Define function to get expectation values of observables w.r.t. a state ==================================#
+def eval_observables(psi, A):
+    """
+    Define a function to obtain the expectation values of one or several observables w.r.t. one state.
+    This depends on:
+        - psi  (statevector, or density matrix)
+        - A    (observable, or list of observables)
+    An observable is either a 1-D mask (diagonal of a projector, as returned by get_projector_geq_median),
+    a sparse matrix (e.g. from get_projector_sparse), or a dense operator / matrix.
+    The state data and the probabilities are extracted only once, and shared by all observables:
+        - for a mask (or a sparse diagonal matrix), <A> reduces to the probabilities weighted by the diagonal.
+        - for a statevector and any other operator, <A> is computed as vdot(psi, A psi).
+        - for a density matrix rho and any other operator, <A> is computed as trace(A rho).
+    The output of this function is the expectation value, or the list of expectation values if A is a list.
+    """
+    observables = A if isinstance(A, (list, tuple)) else [A]  # treat a single observable as a list of one
+    data        = np.asarray(psi.data)                        # get state data once
+    is_rho      = data.ndim == 2                              # density matrices are 2-D, statevectors 1-D
+    vec         = data.ravel()                                # flatten amplitudes once (only used for statevectors)
+    probs       = get_state_probs(psi)                        # get probabilities once for all diagonal observables
+    evals       = []                                          # init. list to store expectation values
+    for obs in observables:                                   # loop through all observables
+        if np.ndim(obs) == 1:                                 # diagonal projector, given by its mask
+            evals.append(expval_diag(probs, np.asarray(obs))) #   sum of probabilities of selected basis states
+            continue
+        if sp.issparse(obs) and obs.format == 'dia' and np.array_equal(obs.offsets, [0]):
+            evals.append(expval_diag(probs, obs.diagonal()))  #   sparse diagonal projector: same as its mask
+            continue
+        mat = obs if sp.issparse(obs) else np.asarray(obs)    # sparse or dense operator
+        if is_rho:
+            evals.append(np.trace(np.asarray(mat @ data)))    #   trace(A rho)
+        else:
+            evals.append(np.vdot(vec, mat @ vec))             #   <psi|A|psi>
+    return evals if isinstance(A, (list, tuple)) else evals[0]
+
+
+
+#==== Cache of transpiled circuits, keyed by circuit digest ==#
+_transpile_cache = {}                                         # maps circuit digest -> transpiled circuit
+
+
+#==== Define a function to get a digest of a circuit =========#
+def circuit_digest(qc, backend_key):
     """
-    probs      = psi.probabilities()                          # get probabilities list from input statevector psi
-    median     = statistics.median(probs)                     # identify median value of probabilities list
-    state_list = []                                           # init. list to store 1s and 0s associated w/ basis state probs
-    for i in range(len(probs)):                               # loop through list of probabilities from psi
-        if   probs[i] <  median: state_list.append(0)         # basis state w/ prob less    than     median: add a 0 to the list
-        elif probs[i] >= median: state_list.append(1)         # basis state w/ prob greater or equal median: add a 1 to the list
-    projector  = Statevector(state_list).to_operator()        # create statevector from state list; convert to proj operator
-    return projector                                          # return the resultant projector operator
+    Define a function to obtain a digest identifying a circuit and the backend it is transpiled for.
+    The digest depends on:
+        - qc           (quantum circuit)
+        - backend_key  (tuple identifying the simulator backend and basis gates, see get_or_transpile)
+    Every instruction contributes its name, the indices of the qubits it acts on, and its parameters,
+    so structurally-identical circuits share a digest even if they are different objects.
+    Array parameters (e.g. the matrix of a UnitaryGate) are hashed by their shape, dtype, and raw bytes, 
+    since the repr of a large array is truncated with '...' and would not tell different arrays apart.
+    The output of this function is the blake2b digest (bytes).
+    """
+    index = {q: i for i, q in enumerate(qc.qubits)}           # index of every qubit, looked up once per circuit
+    h     = hashlib.blake2b(repr(backend_key).encode())       # backend part of the key
+    for inst in qc.data:                                      # loop through all instructions of the circuit
+        qubits = tuple(index[q] for q in inst.qubits)
+        h.update(repr((inst.operation.name, qubits, len(inst.operation.params))).encode())
+        for param in inst.operation.params:                   # add every parameter of the instruction
+            if isinstance(param, np.ndarray):                 # arrays: exact contents, not their (truncated) repr
+                h.update(repr(('array', param.shape, param.dtype.str)).encode())
+                h.update(np.ascontiguousarray(param).tobytes())
+            else:
+                h.update(repr(param).encode())
+            h.update(b'|')                                    # separate parameters
+    return h.digest()                                         # return digest of the whole key
+
+
+#==== Define a function to transpile, reusing cached results =#
+def get_or_transpile(qc, sim, basis_gates=None):
+    """
+    Define a function to transpile a circuit (or a list of circuits) for sim, reusing the transpiled circuit 
+    of any structurally-identical circuit transpiled before (see circuit_digest).
+    All circuits of a list not found in the cache are transpiled together in a single transpile call.
+    Only basis translation is needed for the simulators, so optimization passes are disabled; circuits already 
+    made of basis_gates only (plus barriers and save instructions) need none, and are returned as they are
+    without being hashed or cached (e.g. the many one-off circuits sampled for PEC).
+    The output of this function is the transpiled quantum circuit (or list of them).
+    """
+    qcs     = qc if isinstance(qc, list) else [qc]            # treat a single circuit as a list of one
+    backend = (sim.name, tuple(basis_gates or ()))            # backend part of every digest, built once per call
+    allowed = set(basis_gates or ()) | {'barrier'}            # instructions which need no translation
+    qcs_out = list(qcs)                                       # circuits already in basis are used as they are
+    digests = {}                                              # digest of every circuit to transpile, by position
+    missing = {}                                              # circuits not seen before, by digest
+    for i, c in enumerate(qcs):
+        names = c.count_ops().keys()                          # names of all instructions of the circuit
+        if basis_gates and all(k in allowed or k.startswith('save_') for k in names):
+            continue                                          # already in basis: nothing to transpile
+        digests[i] = circuit_digest(c, backend)               # get digest of circuit + backend
+        if digests[i] not in _transpile_cache:
+            missing[digests[i]] = c
+    if missing:                                               # transpile only circuits not seen before, at once
+        transpiled = transpile(list(missing.values()), sim, basis_gates=basis_gates,
+                               optimization_level=0)
+        _transpile_cache.update(zip(missing.keys(), transpiled))
+    for i, digest in digests.items():
+        qcs_out[i] = _transpile_cache[digest]                 # get cached transpiled circuits
+    return qcs_out if isinstance(qc, list) else qcs_out[0]    # return transpiled circuit(s)
 
 
 
 #==== Define a function to run ideal sim, get exp. val of A ==#
-def ideal_sim(qc, A, M):
+def ideal_sim(qc, A, sim_ideal=None):
     #==== Simulate Ideal Circuit =============================#
     """
     When simulating ideal circuits, changing the method between the exact simulation methods: 
     stabilizer, statevector, density_matrix, and matrix_product_state, should not change the simulation result.
-    We choose the statevector simulator here, since it doesn't matter which of the above we choose for the ideal 
-    circuit, but we want to obtain the statevector result from the noisy circuit. 
+    By default we evolve the statevector directly with the Statevector class, which skips the simulator job entirely.
+    Save instructions (e.g. save_density_matrix, needed by noise_sim) are skipped, since they have no effect on the state.
+    If sim_ideal is given (e.g. get_ideal_sim()), the statevector is instead computed by that Aer backend
+    (see get_ideal_state_aer), whose compiled kernels are faster for larger n and d.
     """
-    sim_ideal    = AerSimulator(method='statevector')         # get statevector simulation method backend
-    qc_ideal     = transpile(qc, sim_ideal)                   # transpile ideal circuit
-    result_ideal = sim_ideal.run(qc_ideal, shots=M).result()  # run ideal simulation 
+    if sim_ideal is not None:                                 # evolve with the Aer statevector simulator
+        psi_ideal = get_ideal_state_aer(qc, sim_ideal)
+    else:                                                     # evolve with the Statevector class
+        qc_ideal  = qc.copy_empty_like()                      # create empty copy of ideal circuit
+        for inst in qc.data:                                  # loop through all instructions of ideal circuit
+            if not inst.operation.name.startswith('save_'):   # keep every instruction but simulator save instructions
+                qc_ideal.append(inst.operation, inst.qubits, inst.clbits)
+        psi_ideal = Statevector.from_instruction(qc_ideal)    # evolve ground state by the ideal circuit
     #==== Calculate ideal expectation values =================#
-    psi_ideal    = result_ideal.get_statevector(0)            # get statevector from noisy circuit
-    eval_ideal   = psi_ideal.expectation_value(A)             # get noisy expectation value from projector A w.r.t. noisy psi
+    eval_ideal   = eval_observables(psi_ideal, A)             # get ideal expectation value(s) of A w.r.t. ideal psi
     return eval_ideal
 
 
+#==== Define a function to build the ideal simulator ========#
+@lru_cache(maxsize=None)
+def get_ideal_sim(precision='double'):
+    """
+    Define a function to build the (noiseless) Aer statevector simulator backend for ideal simulations.
+    The backend is built once per process and shared; it runs on a single thread, since the circuits are
+    already evaluated in parallel worker processes.
+    The output of this function is the AerSimulator.
+    """
+    return AerSimulator(method='statevector', precision=precision,
+                        max_parallel_threads=1)               # return ideal statevector simulator backend
+
+
+#==== Define a function to get the ideal statevector via Aer =#
+def get_ideal_state_aer(qc, sim_ideal=None):
+    """
+    Define a function to obtain the ideal final statevector of a circuit (applied to the ground state) with Aer.
+    Aer applies the gates with its compiled kernels in a single job, instead of one Python-level tensor 
+    contraction per gate as Statevector.evolve does; this pays off for larger n and d.
+    The circuit itself is left untouched: the save_statevector instruction is added to a copy.
+    The output of this function is the ideal Statevector.
+    """
+    if sim_ideal is None:                                     # use the shared ideal simulator if none is given
+        sim_ideal = get_ideal_sim()
+    qc_save = qc.copy()                                       # copy circuit, so the caller's circuit gets no save instruction
+    qc_save.save_statevector()                                # save final statevector
+    result  = sim_ideal.run(qc_save, shots=1).result()        # run ideal simulation (no transpile needed: no noise / basis)
+    return result.data(0)['statevector']                      # return saved statevector
+
+
+#==== Define a function to build the noisy simulator ========#
+def get_noise_sim(noise_model, basis_gates, precision='single', method='density_matrix'):
+    """
+    Define a function to build the simulator backend for noisy simulations.
+    Building the backend is not free, so it should be built once per noise model and passed to noise_sim().
+    By default the density matrix is simulated: for the small n used here, one deterministic evolution under the 
+    noise channels gives the exact noisy expectation value, without any Monte-Carlo sampling of the noise.
+    Circuits must then end with save_density_matrix() (or save_statevector() for method='statevector').
+    The state is simulated in single precision (complex64) by default: the statistical error of the 
+    PEC estimate dominates by far, and single precision halves the memory traffic of the simulation.
+    The output of this function is the AerSimulator.
+    """
+    sim_noise = AerSimulator(method=method,
+                             precision=precision,
+                             noise_model=noise_model,
+                             basis_gates=basis_gates)         # set noise model as depolarizing noise model
+    return sim_noise                                          # return the noisy simulator backend
+
+
+#==== Define a function to get the saved state of a result ==#
+def get_saved_state(result, i):
+    """
+    Define a function to obtain the state saved at the end of the i-th circuit of a simulator result:
+    the density matrix if the circuit saved one, otherwise the statevector.
+    """
+    data = result.data(i)                                     # get saved data of i-th circuit
+    if 'density_matrix' in data:
+        return data['density_matrix']                         # return saved density matrix
+    return data['statevector']                                # return saved statevector
+
+
 #==== Define a function to run noisy sim, get exp. val of A ==#
-def noise_sim(qc, A, M, noise_model, basis_gates):
+def noise_sim(qc, A, noise_model, basis_gates, sim_noise=None):
     #==== Perform a noise simulation =========================#
-    sim_noise    = AerSimulator(noise_model=noise_model,
-                                basis_gates=basis_gates)      # set noise model as depolarizing noise model
-    qc_noise     = transpile(qc, sim_noise)                   # transpile noisy circuit
-    result_noise = sim_noise.run(qc_noise,shots=M).result()   # run noisy simulation
+    """
+    Only the state saved at the end of the circuit is used, so a single shot is run: with the (default) density 
+    matrix simulator the noise is applied exactly, with method='statevector' the state is one noise trajectory.
+    """
+    if sim_noise is None:                                     # build simulator only if not pre-built by caller
+        sim_noise = get_noise_sim(noise_model, basis_gates)   # set noise model as depolarizing noise model
+    qc_noise     = get_or_transpile(qc, sim_noise, basis_gates)  # transpile noisy circuit (cached)
+    result_noise = sim_noise.run(qc_noise,shots=1).result()   # run noisy simulation (saved state only needs one shot)
     #==== Calculate noisy expectation values =================#
-    psi_noise  = result_noise.get_statevector(0)              # get statevector from noisy circuit
-    eval_noise = psi_noise.expectation_value(A)               # get noisy expectation value from projector A w.r.t. noisy psi
+    psi_noise  = get_saved_state(result_noise, 0)             # get saved state from noisy circuit
+    eval_noise = eval_observables(psi_noise, A)               # get noisy expectation value(s) of A w.r.t. noisy state
     return eval_noise
 
 
+#==== Define a function to submit many noisy sims as one job #
+def noise_sim_submit(qcs, noise_model, basis_gates, sim_noise=None):
+    """
+    Define a function to submit the noisy simulations of many circuits to the simulator as a single job.
+    All circuits are submitted as one job, so Aer can run them in parallel instead of paying the job overhead 
+    once per circuit (a single shot each). Aer runs the job asynchronously: this function returns right away,
+    so the caller can do other work (e.g. on the ideal results) while the noisy simulations run.
+    The output of this function is the AerJob; pass it to noise_sim_collect to get the expectation values.
+    """
+    if sim_noise is None:                                     # build simulator only if not pre-built by caller
+        sim_noise = get_noise_sim(noise_model, basis_gates)   # set noise model as depolarizing noise model
+    qcs_noise = get_or_transpile(list(qcs), sim_noise,
+                                 basis_gates)                 # transpile noisy circuits (cached; one transpile call)
+    return sim_noise.run(qcs_noise,shots=1)                   # submit all noisy simulations in one (non-blocking) job
+
+
+#==== Define a function to collect the results of noisy sims #
+def noise_sim_collect(job, As):
+    """
+    Define a function to wait for a job from noise_sim_submit and evaluate its saved states:
+    the state of circuit i is evaluated against observable As[i].
+    If every observable is a boolean mask (see get_projector_geq_median), all expectation values are obtained in one
+    masked reduction over the stacked probabilities of all saved states.
+    The output of this function is the list of noisy expectation values.
+    """
+    result_noise = job.result()                               # wait for all noisy simulations to finish
+    if len(As) and all(np.asarray(A).dtype == np.bool_ for A in As):  # only masks: one fused reduction
+        probs = np.stack([get_state_probs(get_saved_state(result_noise, i))
+                          for i in range(len(As))])           # probabilities of all saved states, one row per circuit
+        masks = np.stack(As)                                  # masks of all circuits, one row per circuit
+        return np.sum(probs, axis=1, where=masks).tolist()    # sum selected probabilities of every state at once
+    evals_noise  = []                                         # init. list to store noisy expectation values
+    for i in range(len(As)):                                  # loop through all circuits
+        psi_noise = get_saved_state(result_noise, i)          # get saved state from i-th noisy circuit
+        evals_noise.append(eval_observables(psi_noise, As[i]))  # get noisy expectation value of As[i] w.r.t. noisy state
+    return evals_noise
+
+
+#==== Define a function to run many noisy sims in one job ===#
+def noise_sim_batch(qcs, As, noise_model, basis_gates, sim_noise=None):
+    """
+    Batched version of noise_sim: circuit qcs[i] is evaluated against observable As[i] (a single shot each).
+    This is noise_sim_submit followed directly by noise_sim_collect.
+    The output of this function is the list of noisy expectation values.
+    """
+    job = noise_sim_submit(qcs, noise_model, basis_gates, sim_noise)  # submit all noisy simulations in one job
+    return noise_sim_collect(job, As)                         # wait for the job, get noisy evs
+
+
+#==== Define a function to approximate noisy evs analytically #
+def calc_global_dk_eval(eval_ideal, n, d, epsilon, frac_A=0.5):
+    """
+    Define a function to approximate the noisy expectation value of A without running a noisy simulation.
+    This depends on:
+        - eval_ideal  (ideal expectation value(s) of A; scalar or array)
+        - n, d        (number of qubits, circuit depth; see get_qc_ub)
+        - epsilon     (error rate of the depolarizing channels; see get_dk_noise)
+        - frac_A      (tr(A)/2^n, the fraction of basis states selected by A; scalar or array, 1/2 for the median projector)
+    Every gate of get_qc_ub is followed by a depolarizing channel rho -> (1-epsilon) rho + epsilon I/2^q.
+    Treating all of them as one global depolarizing channel, the state becomes (1-p_eff) rho + p_eff I/2^n with
+        1 - p_eff = (1-epsilon)^(number of noisy gates),  with the gates counted by count_noisy_gates,
+    so that <A>_noisy = (1-p_eff) <A>_ideal + p_eff tr(A)/2^n.
+    This is an approximation: local channels are only equivalent to a global one on average over random circuits.
+    The output of this function is the approximate noisy expectation value(s).
+    """
+    num_gates = sum(count_noisy_gates(n, d))                  # number of gates followed by a depolarizing channel
+    p_eff     = -np.expm1(num_gates*np.log1p(-epsilon))       # 1 - (1-epsilon)^num_gates, accurate for small epsilon
+    return (1-p_eff)*np.asarray(eval_ideal) + p_eff*np.asarray(frac_A)  # return mix of ideal ev and fully mixed ev
+
+
+#==== Define a function to get the n-qubit ground state =====#
+@lru_cache(maxsize=None)
+def get_ground_state(n):
+    """
+    Define a function to obtain the n-qubit ground state |0...0> as a Statevector.
+    The state is built once per n and shared; evolve() returns a new state, so it is never modified.
+    """
+    return Statevector.from_int(0, 2**n)                      # return ground state using from_int
+
+
+#==== Cache of ideal results, keyed by the random choices ====#
+_ideal_cache = {}                                             # maps ideal_digest -> (A, eval_ideal)
+
+
+#==== Define a function to get a digest of the random choices #
+def ideal_digest(n, d, single_gates, gate_idx, perm_idx):
+    """
+    Define a function to obtain a digest identifying a random circuit by the choices it was built from.
+    The digest depends on n, d, the names of single_gates, and the bytes of gate_idx and perm_idx (see sample_qc_ub),
+    so a circuit drawn again with the same seed (e.g. when sweeping epsilon) maps to the same digest.
+    The output of this function is the blake2b digest (bytes).
+    """
+    h = hashlib.blake2b(repr((n, d, [g.name for g in single_gates])).encode())
+    h.update(np.ascontiguousarray(gate_idx, dtype=np.int64).tobytes())  # add gate choices
+    h.update(np.ascontiguousarray(perm_idx, dtype=np.int64).tobytes())  # add qubit permutations
+    return h.digest()                                         # return digest of the random choices
+
+
+#==== Define a function to build & ideally simulate a circuit #
+def circ_sample(n, d, single_gates, gate_idx, perm_idx, ideal_aer=False):
+    """
+    Define a function to build one random circuit and evaluate it ideally; one independent sample of the sweep.
+    This function depends on:
+        - n, d, single_gates  (see get_qc_ub)
+        - gate_idx, perm_idx  (pre-sampled random choices of this circuit, see sample_qc_ub)
+        - ideal_aer           (optional; get the ideal statevector from the Aer simulator instead of Statevector.evolve)
+    Observable A is chosen as a projector onto the subset of 2^(n-1) basis states whose probability
+    in the final state of the ideal circuit is above the median value (temme, 2017).
+    The ideal expectation value is taken from the same exact statevector A is derived from; no simulator is run.
+    (A, eval_ideal) are cached per process by ideal_digest, so repeated circuits (e.g. an epsilon sweep with a 
+    fixed seed) skip the ideal evolution; the circuit itself is always rebuilt, since the noisy simulation needs it.
+    A density matrix checkpoint is added to the end of the circuit, so that noise_sim is able to extract the noisy state.
+    The function only depends on its arguments, so samples can be evaluated in parallel.
+    The output of this function is the tuple (qc, A, eval_ideal).
+    """
+    #==== Build quantum circuit ==============================#
+    qc  = get_qc_ub(n, d, single_gates, gate_idx=gate_idx,
+                    perm_idx=perm_idx)                        # create ideal quantum circuit from pre-sampled choices
+    key = ideal_digest(n, d, single_gates, gate_idx, perm_idx)  # identify circuit by its random choices
+    if key in _ideal_cache:                                   # ideal result already known: reuse it
+        A, eval_ideal = _ideal_cache[key]
+        qc.save_density_matrix()                              # add save density matrix checkpoint to end of qc
+        return qc, A, eval_ideal
+    #==== Evolve Statevector by quantum circuit ==============#
+    if ideal_aer:
+        psi = get_ideal_state_aer(qc)                         # get final state from the Aer statevector simulator
+    else:
+        psi = get_ground_state(n)                             # get initial simulator state (ground state; cached)
+        psi = psi.evolve(qc)                                  # evolve the state by the quantum circuit (returns new state)
+    #==== Get projector operator A ===========================#
+    probs = get_state_probs(psi)                              # get probabilities of psi once (real^2 + imag^2); shared by A and its ev
+    A     = get_projector_geq_median(psi, probs)              # get projector A (as its diagonal mask) from statevector psi
+    #==== Calculate ideal expectation value ==================#
+    eval_ideal = expval_diag(probs, A)                        # get ideal expectation value from projector A w.r.t. statevector psi
+    _ideal_cache[key] = (A, eval_ideal)                       # store ideal result for repeated circuits
+    qc.save_density_matrix()                                  # add save density matrix checkpoint to end of qc
+    return qc, A, eval_ideal                                  # return circuit, projector, and ideal expectation value
+
+
+#==== Define a function to get the matrices of single gates ==#
+def get_gate_mats(single_gates):
+    """
+    Define a function to obtain the 2x2 unitaries of a list of single-qubit gates, e.g. for circ_sample_core.
+    The output of this function is a (len(single_gates), 2, 2) complex128 array.
+    """
+    return np.stack([np.asarray(g.to_matrix(), dtype=np.complex128) for g in single_gates])
+
+
+#==== Define a compiled function to apply a Pauli ===========#
+@njit(cache=True)
+def apply_pauli(psi, k, q):
+    """
+    Define a function to apply the Pauli k (1: X, 2: Y, 3: Z; as in the frames of sample_pauli_frames) to qubit q
+    of the statevector psi, in place, by bit manipulation instead of a 2x2 matrix product:
+    X swaps the amplitudes differing in bit q, Z flips the sign of the amplitudes with bit q set,
+    and Y = iXZ does both, with phases -i (to bit q = 0) and +i (to bit q = 1).
+    """
+    step = 1 << q                                             # index offset of qubit q
+    for i in range(psi.shape[0]):
+        if k == 3:                                            # Z: sign flip where bit q is 1
+            if i & step != 0:
+                psi[i] = -psi[i]
+        elif i & step == 0:                                   # X, Y: amplitude pair (i, i+step)
+            a0, a1 = psi[i], psi[i+step]
+            if k == 1:
+                psi[i], psi[i+step] = a1, a0                  # X: swap
+            else:
+                psi[i], psi[i+step] = -1j*a1, 1j*a0           # Y: swap with phases
+
+
+#==== Define a compiled function to apply a 1-qubit gate ====#
+@njit(cache=True)
+def apply_1q(psi, u, q):
+    """
+    Define a function to apply the 2x2 unitary u to qubit q of the statevector psi, in place.
+    Qubit q is bit q of the basis state index (little endian, as in Qiskit), so u mixes every pair of 
+    amplitudes whose indices differ only in that bit.
+    """
+    step = 1 << q                                             # index offset of qubit q
+    for i in range(psi.shape[0]):
+        if i & step == 0:                                     # amplitude pair (i, i+step) differs in qubit q
+            a0, a1      = psi[i], psi[i+step]
+            psi[i]      = u[0,0]*a0 + u[0,1]*a1
+            psi[i+step] = u[1,0]*a0 + u[1,1]*a1
+
+
+#==== Define a compiled function to apply a CNOT ============#
+@njit(cache=True)
+def apply_cx(psi, c, t):
+    """
+    Define a function to apply a CNOT with control qubit c and target qubit t to the statevector psi, in place:
+    every pair of amplitudes whose control bit is 1 and which differ only in the target bit is swapped.
+    """
+    c_bit = 1 << c                                            # index offset of control qubit
+    t_bit = 1 << t                                            # index offset of target  qubit
+    for i in range(psi.shape[0]):
+        if i & c_bit != 0 and i & t_bit == 0:                 # control set: swap with target flipped
+            psi[i], psi[i+t_bit] = psi[i+t_bit], psi[i]
+
+
+#==== Define a compiled function to evolve a circuit ========#
+@njit(cache=True)
+def evolve_qc_ub(psi, n, d, gate_mats, gate_idx, perm_idx, frames):
+    """
+    Define a function to evolve the statevector psi in place by one circuit of get_qc_ub.
+    This function depends on:
+        - psi                 (statevector, overwritten; complex array of length 2^n)
+        - n, d                (number of qubits, circuit depth; see get_qc_ub)
+        - gate_mats           (unitaries of the single-qubit gates, see get_gate_mats)
+        - gate_idx, perm_idx  ((d//2, n) and ((d+1)//2, n) random choices of the circuit, see sample_qc_ub)
+        - frames              ((k, d, n) int8 Pauli frames, see sample_pec_frames; applied in order after each layer)
+    The layers and qubit ordering follow get_qc_ub; check_numba_kernels compares the result with the Qiskit circuit.
+    """
+    half = n//2                                               # number of CNOTs per even layer
+    for layer in range(d):                                    # loop through all circuit layers
+        if layer%2 != 0:                                      # odd layer: single qubit gates
+            for q in range(n):
+                apply_1q(psi, gate_mats[gate_idx[layer//2, q]], q)
+        else:                                                 # even layer: cnot gates
+            for k in range(half):
+                apply_cx(psi, perm_idx[layer//2, k], perm_idx[layer//2, half+k])
+        for f in range(frames.shape[0]):                      # Pauli frames of this layer, in order
+            for q in range(n):
+                if frames[f, layer, q] != 0:                  # skip identities
+                    apply_pauli(psi, frames[f, layer, q], q)
+
+
+#==== Define a compiled function to ideally sample circuits ==#
+@njit(cache=True)
+def circ_sample_core(n, d, gate_mats, gate_idx, perm_idx):
+    """
+    Define a function to evaluate M random circuits of get_qc_ub ideally, without building any QuantumCircuit.
+    This function depends on:
+        - n, d                (number of qubits, circuit depth; see get_qc_ub)
+        - gate_mats           (unitaries of the single-qubit gates, see get_gate_mats)
+        - gate_idx, perm_idx  (pre-sampled random choices of all M circuits, see sample_qc_ub)
+    The statevector is evolved in place by evolve_qc_ub; the projector and the ideal ev are then obtained as in circ_sample.
+    Compiled with numba, so the whole loop over circuits, layers, and gates runs without Python dispatch.
+    The output of this function is the tuple (A, eval_ideal): the (M, 2^n) projector masks and the M ideal evs.
+    """
+    M         = gate_idx.shape[0]                             # number of circuits
+    dim       = 1 << n                                        # dimension of the statevector
+    A         = np.empty((M, dim), dtype=np.bool_)            # init. array to store projector masks
+    evals     = np.empty(M)                                   # init. array to store ideal evs
+    psi       = np.empty(dim, dtype=np.complex128)            # statevector, reused by all circuits
+    no_frames = np.zeros((0, d, n), dtype=np.int8)            # ideal circuits: no Pauli frames
+    for m in range(M):                                        # loop through all circuits
+        psi[:] = 0                                            # reset to ground state |0...0>
+        psi[0] = 1
+        evolve_qc_ub(psi, n, d, gate_mats, gate_idx[m], perm_idx[m], no_frames)
+        probs    = psi.real**2 + psi.imag**2                  # get probabilities of the final state
+        median   = np.partition(probs, dim//2)[dim//2]        # (upper) median, as in get_projector_geq_median
+        A[m]     = probs >= median                            # projector onto basis states w/ prob >= median
+        evals[m] = np.sum(probs[A[m]])                        # ideal ev: sum of selected probabilities
+    return A, evals                                           # return projector masks and ideal evs
+
+
 #==== Define a function to calculate delta_0 =================#
+@njit(cache=True)
 def calc_delta_zero(eval_ideal, eval_noise):
     #==== Get noisy device simulation precision (delta_0) ====#
-    delta_zero = abs(eval_noise - eval_ideal)                 # calculate absval of difference between evals (delta_0)
+    """
+    Works on scalars, or elementwise on arrays of evals (one call for all circuits). Compiled with numba.
+    """
+    delta_zero = np.abs(eval_noise - eval_ideal)              # calculate absval of difference between evals (delta_0)
     return delta_zero                                         # return delta_0 
 
 
+#==== Define a function to sample Pauli frames ===============#
+def sample_pauli_frames(M, n, d, p_1q, p_cx, perm_idx, seed=None):
+    """
+    Define a function to draw M Pauli frames for one circuit built by get_qc_ub.
+    This function depends on:
+        - M           (number of frames)
+        - n, d        (number of qubits, circuit depth)
+        - p_1q, p_cx  (probability of a non-identity Pauli after a single-qubit gate / after a CNOT)
+        - perm_idx    (((d+1)//2, n) qubit permutations of the circuit, see sample_qc_ub; pairs the CNOT qubits)
+        - seed        (seed or Generator for the NumPy RNG)
+    After a single-qubit gate the Pauli is uniform among X, Y, Z; after a CNOT it is uniform among the 15 
+    non-identity 2-qubit Paulis, split into one Pauli on the control and one on the target.
+    The output of this function is the tuple (frames, num_hits): frames is an (M, d, n) int8 array of the Pauli
+    (0: I, 1: X, 2: Y, 3: Z) applied to each qubit after each layer, num_hits the (M,) number of gates hit.
+    """
+    rng       = np.random.default_rng(seed)                   # get NumPy RNG (reuses seed if already a Generator)
+    half      = n//2                                          # number of CNOTs per even layer
+    perm_idx  = np.asarray(perm_idx)
+    frames    = np.zeros((M, d, n), dtype=np.int8)            # init. all corrections as identities
+    #==== Single-qubit gate layers (odd) =====================#
+    hit_1q    = rng.random((M, d//2, n)) < p_1q               # which gates get a Pauli
+    pauli_1q  = rng.integers(1, 4, size=hit_1q.shape, dtype=np.int8)   # which Pauli (X, Y, Z)
+    frames[:, 1::2, :] = np.where(hit_1q, pauli_1q, 0)        # write corrections of odd layers
+    #==== CNOT layers (even) =================================#
+    hit_cx    = rng.random((M, (d+1)//2, half)) < p_cx        # which CNOTs get a Pauli
+    pauli_cx  = rng.integers(1, 16, size=hit_cx.shape, dtype=np.int8)  # which 2-qubit Pauli (4*ctrl + targ; not I x I)
+    pauli_cx  = np.where(hit_cx, pauli_cx, 0)
+    ctrl      = np.broadcast_to(perm_idx[:, :half], hit_cx.shape)         # control qubit of each CNOT
+    targ      = np.broadcast_to(perm_idx[:, half:2*half], hit_cx.shape)   # target  qubit of each CNOT
+    even      = frames[:, 0::2, :]                            # view of the CNOT layers
+    np.put_along_axis(even, ctrl, pauli_cx // 4, axis=2)      # Pauli on control qubit
+    np.put_along_axis(even, targ, pauli_cx %  4, axis=2)      # Pauli on target  qubit
+    num_hits  = hit_1q.sum(axis=(1, 2)) + hit_cx.sum(axis=(1, 2))  # number of gates followed by a Pauli
+    return frames, num_hits                                   # return Pauli frames and number of gates hit
+
+
+#==== Define a function to sample PEC Pauli frames ===========#
+def sample_pec_frames(M, n, d, epsilon, perm_idx, seed=None):
+    """
+    Define a function to draw the Pauli corrections of M PEC samples of one circuit built by get_qc_ub.
+    This function depends on:
+        - M         (number of PEC samples)
+        - n, d      (number of qubits, circuit depth)
+        - epsilon   (error rate of the depolarizing channels; see get_dk_noise)
+        - perm_idx  (qubit permutations of the circuit, see sample_pauli_frames)
+        - seed      (seed or Generator for the NumPy RNG)
+    The inverse of a q-qubit depolarizing channel of strength epsilon is a quasi-probability mix of Paulis: 
+    the identity with weight 1 + (4^q-1) epsilon/(4^q (1-epsilon)), each other Pauli with weight -epsilon/(4^q (1-epsilon)).
+    After every gate, a non-identity Pauli is thus drawn with probability 3 epsilon/(4 + 2 epsilon) (single-qubit gates) 
+    or 15 epsilon/(16 + 14 epsilon) (CNOTs), uniformly among the 3 (15) Paulis, and flips the sign of the sample.
+    The norms of these quasi-probabilities are the per-gate factors of the PEC overhead (see calc_pec_overhead).
+    The output of this function is the tuple (frames, signs): frames is the (M, d, n) int8 array of Pauli corrections
+    (see sample_pauli_frames), signs is the (M,) array of +1/-1.
+    """
+    p_1q      = 3*epsilon / (4 + 2*epsilon)                   # probability of a Pauli after a single-qubit gate
+    p_cx      = 15*epsilon / (16 + 14*epsilon)                # probability of a Pauli after a CNOT
+    frames, num_neg = sample_pauli_frames(M, n, d, p_1q, p_cx, perm_idx, seed)  # draw corrections of all samples
+    signs     = np.where(num_neg % 2, -1.0, 1.0)              # sign of each sample (one flip per negative weight)
+    return frames, signs                                      # return Pauli frames and signs of all samples
+
+
+#==== Define a function to sample depolarizing errors ========#
+def sample_dk_frames(M, n, d, epsilon, perm_idx, seed=None):
+    """
+    Define a function to draw M noise trajectories of the depolarizing noise model of get_dk_noise, as Pauli frames.
+    A q-qubit depolarizing channel of strength epsilon applies a uniformly random q-qubit Pauli (identity included)
+    with probability epsilon, i.e. a non-identity Pauli with probability (4^q-1)/4^q epsilon.
+    Averaged over trajectories, the pure states evolved with these frames reproduce the noisy density matrix.
+    The output of this function is the (M, d, n) int8 array of Pauli errors (see sample_pauli_frames).
+    """
+    frames, _ = sample_pauli_frames(M, n, d, 3*epsilon/4, 15*epsilon/16, perm_idx, seed)
+    return frames                                             # return Pauli errors of all trajectories
+
+
+#==== Define a compiled function to run PEC samples ==========#
+@njit(cache=True)
+def pec_trials_core(n, d, gate_mats, gate_idx, perm_idx, err_frames, pec_frames, A, psi):
+    """
+    Define a function to evaluate M PEC samples of one circuit of get_qc_ub, without building any QuantumCircuit.
+    This function depends on:
+        - n, d                (number of qubits, circuit depth; see get_qc_ub)
+        - gate_mats           (unitaries of the single-qubit gates, see get_gate_mats)
+        - gate_idx, perm_idx  (random choices of the circuit, see sample_qc_ub)
+        - err_frames          ((M, d, n) depolarizing errors of each sample, see sample_dk_frames)
+        - pec_frames          ((M, d, n) Pauli corrections of each sample, see sample_pec_frames)
+        - A                   (projector mask, see get_projector_geq_median)
+        - psi                 (work buffer for the statevector, of length 2^n; overwritten)
+    The precision is set by the dtype of psi and gate_mats: complex64 halves the memory traffic of every pass,
+    and single precision is ample here, since the statistical error of the PEC average dominates by far.
+    The expectation values are still accumulated in double precision.
+    Each sample is one noise trajectory: after every layer its errors, then its corrections are applied.
+    This is an unbiased single-shot estimate of the noisy ev that circ_sample's density matrix gives exactly.
+    The output of this function is the (M,) array of expectation values of A, to be passed to aggregate_pec.
+    """
+    M      = err_frames.shape[0]                              # number of samples
+    dim    = 1 << n                                           # dimension of the statevector
+    evals  = np.empty(M)                                      # init. array to store evs of samples
+    frames = np.empty((2, d, n), dtype=np.int8)               # errors and corrections of one sample
+    for m in range(M):                                        # loop through all samples
+        psi[:] = 0                                            # reset to ground state |0...0>
+        psi[0] = 1
+        frames[0] = err_frames[m]
+        frames[1] = pec_frames[m]
+        evolve_qc_ub(psi, n, d, gate_mats, gate_idx, perm_idx, frames)
+        total = 0.0
+        for i in range(dim):                                  # ev of A: sum of selected probabilities
+            if A[i]:
+                total += float(psi[i].real)**2 + float(psi[i].imag)**2
+        evals[m] = total
+    return evals                                              # return evs of all samples
+
+
+#==== Define a function to aggregate the PEC estimator =======#
+@njit(cache=True, fastmath=True)
+def aggregate_pec(signs, evals, gamma_b):
+    """
+    Define a function to compute the PEC estimate of an ideal expectation value.
+    The estimate depends on:
+        - signs    (sign of the quasi-probability of each sampled circuit; array of +1/-1)
+        - evals    (expectation value measured for each sampled circuit; float array)
+        - gamma_b  (PEC overhead of the circuit, see calc_pec_overhead; calc_sim_overhead is biased for odd n or d)
+    Each sample is weighted by gamma_b times its sign, and the weighted samples are averaged.
+    Compiled with numba, since this is evaluated over every Monte-Carlo sample.
+    The output of this function is the mitigated expectation value.
+    """
+    total = 0.0                                               # initialize sum of signed expectation values
+    for i in range(evals.shape[0]):                           # loop through all sampled circuits
+        total += signs[i] * evals[i]                          # add signed expectation value of sample
+    return gamma_b * total / evals.shape[0]                   # return gamma_b times mean of signed values
+
+
+#==== Define a function to check the compiled kernels ========#
+def check_numba_kernels(single_gates, gate_names, pairs=((2, 1), (3, 3), (4, 4), (5, 6), (5, 5)), M=2000,
+                        epsilon=0.1, n_max_noise=3, seed=0):
+    """
+    Define a function to check the compiled kernels against Qiskit on a few small random circuits.
+    This function depends on:
+        - single_gates, gate_names  (single-qubit gates of get_qc_ub and their identifiers, as for get_dk_noise)
+        - pairs                     ((n, d) pairs to check; include odd n (idle qubit) and odd d (last layer of CNOTs))
+        - M                         (number of noise trajectories compared to the density matrix)
+        - epsilon                   (error rate of the depolarizing channels)
+        - n_max_noise               (largest n for which the density matrix is simulated by Aer)
+        - seed                      (seed or Generator for the NumPy RNG)
+    For every pair, one random circuit is drawn and checked three ways:
+        - evolve_qc_ub and circ_sample_core against Statevector.evolve of get_qc_ub (amplitudes, A, and ideal ev);
+          A is only compared away from the median, since tied probabilities can round differently by an ulp;
+        - pec_trials_core with error and correction frames against get_qc_ub with their product as pauli_frame 
+          (a Pauli product is only defined up to a phase, so only the ev of A is compared);
+        - for n <= n_max_noise, the mean of M trajectories of sample_dk_frames against the Aer density matrix
+          of get_dk_noise, within 5 standard errors.
+    A ValueError is raised on the first mismatch, so the numba path is only used once it agrees with Qiskit.
+    """
+    rng       = np.random.default_rng(seed)                   # get NumPy RNG (reuses seed if already a Generator)
+    gate_mats = get_gate_mats(single_gates)                   # unitaries of the single-qubit gates (double precision)
+    to_x      = np.array([0, 1, 1, 0], dtype=np.int8)         # X part of each Pauli (0: I, 1: X, 2: Y, 3: Z)
+    to_z      = np.array([0, 0, 1, 1], dtype=np.int8)         # Z part of each Pauli
+    from_xz   = np.array([[0, 3], [1, 2]], dtype=np.int8)     # Pauli of each (X part, Z part)
+    for n, d in pairs:
+        gate_idx, perm_idx = sample_qc_ub(1, n, d, len(single_gates), seed=rng)
+        qc       = get_qc_ub(n, d, single_gates, gate_idx=gate_idx[0], perm_idx=perm_idx[0])
+        psi_ref  = get_ground_state(n).evolve(qc)             # reference state from Qiskit
+        probs    = get_state_probs(psi_ref)
+        A_ref    = get_projector_geq_median(psi_ref, probs)
+        #==== Ideal evolution ================================#
+        psi      = np.zeros(1 << n, dtype=np.complex128)
+        psi[0]   = 1
+        evolve_qc_ub(psi, n, d, gate_mats, gate_idx[0], perm_idx[0], np.zeros((0, d, n), dtype=np.int8))
+        A, evals = circ_sample_core(n, d, gate_mats, gate_idx, perm_idx)
+        if not np.allclose(psi, psi_ref.data, atol=1e-10):
+            raise ValueError(f'evolve_qc_ub does not match get_qc_ub for n={n}, d={d}')
+        median   = np.partition(probs, probs.size//2)[probs.size//2]  # (upper) median, as in get_projector_geq_median
+        clear    = np.abs(probs - median) > 1e-10             # exact ties at the median may round either way: skip them
+        if not (np.array_equal(A[0][clear], A_ref[clear])
+                and np.isclose(evals[0], expval_diag(probs, A[0]), rtol=0, atol=1e-10)):
+            raise ValueError(f'circ_sample_core does not match circ_sample for n={n}, d={d}')
+        #==== Pauli frames ===================================#
+        errs, _  = sample_pauli_frames(1, n, d, 0.5, 0.5, perm_idx[0], seed=rng)  # dense frames, so most layers get Paulis
+        corr, _  = sample_pauli_frames(1, n, d, 0.5, 0.5, perm_idx[0], seed=rng)
+        product  = from_xz[to_x[errs] ^ to_x[corr], to_z[errs] ^ to_z[corr]]      # Pauli product, up to a phase
+        psi_ref  = get_ground_state(n).evolve(get_qc_ub(n, d, single_gates, gate_idx=gate_idx[0], perm_idx=perm_idx[0],
+                                                        pauli_frame=product[0]))
+        ev_ref   = expval_diag(get_state_probs(psi_ref), A_ref)
+        ev_pec   = pec_trials_core(n, d, gate_mats, gate_idx[0], perm_idx[0], errs, corr, A_ref,
+                                   np.empty(1 << n, dtype=np.complex128))[0]
+        if not np.isclose(ev_pec, ev_ref, atol=1e-10):
+            raise ValueError(f'pec_trials_core does not match get_qc_ub with Pauli frames for n={n}, d={d}')
+        #==== Noise trajectories =============================#
+        if n > n_max_noise:
+            continue
+        dk_model = get_dk_noise(gate_names, 'cx', epsilon)
+        qc.save_density_matrix()                              # add save density matrix checkpoint to end of qc
+        ev_noise = noise_sim(qc, A_ref, dk_model, dk_model.basis_gates,
+                             sim_noise=get_noise_sim(dk_model, dk_model.basis_gates, precision='double'))
+        errs     = sample_dk_frames(M, n, d, epsilon, perm_idx[0], seed=rng)
+        evs_traj = pec_trials_core(n, d, gate_mats, gate_idx[0], perm_idx[0], errs, np.zeros_like(errs), A_ref,
+                                   np.empty(1 << n, dtype=np.complex128))
+        tol      = 5*evs_traj.std()/np.sqrt(M) + 1e-6         # 5 standard errors of the trajectory mean
+        if abs(evs_traj.mean() - ev_noise) > tol:
+            raise ValueError(f'noise trajectories do not match the density matrix for n={n}, d={d}: '
+                             f'{evs_traj.mean():.4f} vs {ev_noise:.4f}')
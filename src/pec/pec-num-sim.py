@@ -10,29 +10,20 @@
 ###  IMPORT PACKAGES  ###
 #########################
 
-import random 
-import statistics
 import math
+import os
 
 import numpy             as      np
+from   joblib            import (Parallel, delayed, parallel_backend)
 import pandas            as      pd
-import matplotlib        as      mpl
-import matplotlib.pyplot as      plt
-from   collections       import  Counter
-
-import qiskit_aer.noise           as      noise
-from   qiskit.providers.aer.noise import (NoiseModel, depolarizing_error)
-from   qiskit_aer                 import  AerSimulator
-from   qiskit.quantum_info        import (Statevector, DensityMatrix)
+
 from   qiskit.circuit.library     import (IGate, XGate, YGate, ZGate, HGate, TGate, SGate, CXGate)
-from   qiskit.visualization       import (circuit_drawer, plot_histogram)
-from   qiskit.result              import  Result
-from   qiskit                     import (QuantumCircuit, ClassicalRegister, QuantumRegister, transpile, 
-                                          BasicAer, Aer, execute)
 
-from   functions_pec.fcn_pec      import (calc_sim_overhead, get_dk_noise, ideal_sim, noise_sim, calc_delta_zero, 
-                                          get_qc_ub, get_projector_geq_median)
-from   functions_pec.fcn_bin      import (create_bins, find_bin)
+from   functions_pec.fcn_pec      import (calc_pec_overhead, get_dk_noise, get_noise_sim, noise_sim_submit, noise_sim_collect, calc_delta_zero, 
+                                          calc_global_dk_eval, sample_qc_ub, get_qc_ub, circ_sample, get_gate_mats, 
+                                          circ_sample_core, noise_sim_batch, sample_pec_frames, aggregate_pec, 
+                                          sample_dk_frames, pec_trials_core, check_numba_kernels)
+from   functions_pec.fcn_bin      import (create_bin_edges, bin_accumulate)
 
 
 ##########################
@@ -45,16 +36,27 @@ n             = 6                                             # circuit depth
 epsilon       = 0.01                                          # error rate           (0.01 in paper)
 M             = 4000                                          # total number of runs (4000 in paper)
 num_circ      = 50                                           # number of randomly generated circuits to test
-gamma_b       = calc_sim_overhead(n, d, epsilon)              # simulation overhead
+seed          = None                                          # seed for the RNG drawing the random circuits (None: fresh entropy)
+n_jobs        = -1                                            # number of worker processes building circuits (-1: all cores)
+ideal_aer     = False                                         # get ideal statevectors from Aer (faster for larger n, d)
+ideal_numba   = False                                         # evolve ideal statevectors with the compiled core (no circuits built)
+dk_analytic   = False                                         # approximate noisy evs as global depolarizing noise instead of simulating
+run_pec       = False                                         # estimate ideal evs with PEC (M noisy samples per circuit);
+                                                              # costly: M*num_circ density-matrix sims (200000 at defaults), or use pec_numba
+pec_numba     = False                                         # run PEC samples as compiled noise trajectories instead of Aer density matrices
+pec_batch     = 500                                           # number of PEC samples per parallel task (pec_numba)
+pec_dtype     = np.complex64                                  # precision of the statevector of PEC trajectories (pec_numba)
+draw          = os.environ.get('PEC_DRAW') == '1'             # draw circuit / figures only if PEC_DRAW=1 is set
+gamma_pec     = calc_pec_overhead(n, d, epsilon)              # PEC overhead of one circuit (exact gate counts)
 
 #==== Instances of Gates =====================================#
 I             = IGate()                                       # Identity    gate
 I.label       = r'I'                                          # Identity    gate label "I"
-X             = IGate()                                       # X (pauli)   gate
+X             = XGate()                                       # X (pauli)   gate
 X.label       = r'X'                                          # X (pauli)   gate label "X"
-Y             = IGate()                                       # Y (pauli)   gate
+Y             = YGate()                                       # Y (pauli)   gate
 Y.label       = r'Y'                                          # Y (pauli)   gate label "Y"
-Z             = IGate()                                       # Z (pauli)   gate
+Z             = ZGate()                                       # Z (pauli)   gate
 Z.label       = r'Z'                                          # Z (pauli)   gate label "Z"
 H             = HGate()                                       # Hadamard    gate
 H.label       = r'H'                                          # Hadamard    gate label "H"
@@ -83,60 +85,79 @@ bin_quantity  = 40                                            # quantity of bins
 
 
 #==== Create bins for unmitigated deltas =====================#
-bins = create_bins(bin_lower_bnd,bin_width,bin_quantity)      # create bins with parameters defined above
-bins = pd.IntervalIndex.from_tuples(bins)                     # get pandas IntervalIndex of bins
+bins = create_bin_edges(bin_lower_bnd,bin_width,bin_quantity) # create bin edges with parameters defined above
+bins = pd.IntervalIndex.from_breaks(bins)                     # get pandas IntervalIndex of bins
+
+#==== Build depolarizing noise model =========================#
+dk_model = get_dk_noise(gate_names,'cx',epsilon)              # get depolarizing noise model 
+dk_gates = list(dict.fromkeys(dk_model.basis_gates
+                              + paulis_names))                # get basis gates from noise model, plus (noiseless) paulis
+dk_sim   = get_noise_sim(dk_model, dk_gates)                  # build noisy simulator once for all circuits
+
+#==== Check the compiled kernels against Qiskit ==============#
+if ideal_numba or (run_pec and pec_numba):                    # compiled paths are only used once they match Qiskit
+    check_numba_kernels(gate_list, gate_names, epsilon=epsilon)  # raises ValueError on a mismatch
 
 #==== Run simulations and put deltas into bins ===============#
-delta_zero_arr = []                                           # initialize array to hold delta_0 values 
-eval_init_arr  = []                                           # initialize array to hold first calculated ideal ev 
-eval_ideal_arr = []                                           # initialize array to hold ideal ev values
-eval_noise_arr = []                                           # initialize array to hold noisy ev values
-
-for ii in range(num_circ):                                    # perform operation N times; get N delta values
-    #==== Build quantum circuit ==============================#
-    """
-    Build quantum circuit with n qubits, d layers; use function get_qc_ub().
-    Select 1-qubit gates from list: gate_list.
-    """
-    qc  = get_qc_ub(n, d, gate_list)                          # create ideal quantum circuit 
-    # qc.draw('mpl')                                          # draw quantum circuit using matplotlib rendering
-
-    #==== Evolve Statevector by quantum circuit ==============#
-    psi = Statevector.from_int(0, 2**n)                       # set initial simulator state to ground state using from_int
-    psi = psi.evolve(qc)                                      # evolve the state by the quantum circuit
-    psi.draw('latex')                                         # draw using latex rendering
-
-    #==== Get projector operator A ===========================#
-    """
-    Observable A is chosen as a projector onto the subset of 2^(n-1) basis states whose probability
-    in the final state of the ideal circuit is above the median value (temme, 2017).
-    """
-    A   = get_projector_geq_median(psi)                       # get projector A from statevector psi
-
-    #==== Calculate ideal expectation values =================#
-    """
-    TEST!!!
-    The expectation values of the projector operators are complex, but projectors should have real expectation values. 
-    I'm evaluating the expectation values before and after the simulation to compare.
-    """
-    eval_ideal_temp = psi.expectation_value(A)                # get ideal expectation value from projector A w.r.t. statevector psi
-    eval_init_arr.append(eval_ideal_temp)                     # add initial ideal expectation value to array
-
-    #===== Add statevector 'screenshot' end of circuit =======#
-    """
-    This is necessary so that the simulations below are able to extract the statevector.
-    """
-    qc.save_statevector()                                     # add save statevector checkpoint to end of qc
-    #==== Build depolarizing noise model =====================#
-    dk_model = get_dk_noise(gate_names,'cx',epsilon)          # get depolarizing noise model 
-    dk_gates = dk_model.basis_gates                           # get basis gates from depolarizing noise model
-    ev_ideal = ideal_sim(qc,A,M)                              # simulate ideal circ;                 M shots; get ev of observ. A
-    ev_noise = noise_sim(qc,A,M, dk_model, dk_gates)          # simulate circ w/ depolarizing noise; M shots; get ev of observ. A
-    dz       = calc_delta_zero(ev_ideal, ev_noise)            # find  delta_0 for random circuit given defined parameters
-    print("delta_0 ", ii, " is: ", dz)                        # print delta_0 value 
-    delta_zero_arr.append(dz)                                 # add   delta_0 to list of delta_0 values
-    eval_ideal_arr.append(ev_ideal)                           # add ideal expextation valye of A to list of ideal ev values
-    eval_noise_arr.append(ev_noise)                           # add noisy expectation value of A to list of noisy ev values
+rng = np.random.default_rng(seed)                             # RNG for the random circuits, then for the PEC samples
+gate_idx, perm_idx = sample_qc_ub(num_circ, n, d, len(gate_list),
+                                  seed=rng)                   # draw random gate choices for all circuits at once
+
+#==== Build & ideally simulate circuits in parallel ==========#
+"""
+Every random circuit is independent: build it, get its projector A, and its ideal expectation values
+(see circ_sample) in parallel worker processes.
+The random choices are pre-sampled from the seeded RNG above, so results don't depend on the worker scheduling.
+With ideal_numba, the ideal evolution of all circuits instead runs in one compiled call (see circ_sample_core);
+circuits are then only built if the noisy simulator needs them.
+"""
+qc_arr         = [None] * num_circ                            # init. list to store circuits (Python objects)
+A_arr          = [None] * num_circ                            # init. list to store projectors (masks)
+eval_ideal_arr = np.empty(num_circ, dtype=np.float64)         # preallocate array to store ideal evs
+if ideal_numba:
+    A_mat, eval_ideal_arr[:] = circ_sample_core(n, d, get_gate_mats(gate_list),
+                                                gate_idx, perm_idx)  # evolve all circuits ideally (compiled)
+    A_arr[:] = list(A_mat)                                    # one mask (row) per circuit
+    if not dk_analytic:                                       # the noisy simulator needs the circuits
+        for ii in range(num_circ):
+            qc_arr[ii] = get_qc_ub(n, d, gate_list, gate_idx=gate_idx[ii],
+                                   perm_idx=perm_idx[ii])     # create ideal quantum circuit from pre-sampled choices
+            qc_arr[ii].save_density_matrix()                  # add save density matrix checkpoint to end of qc
+else:
+    with parallel_backend('loky', inner_max_num_threads=1):  # one thread per worker, so workers don't oversubscribe cores
+        samples = Parallel(n_jobs=n_jobs)(
+            delayed(circ_sample)(n, d, gate_list, gate_idx[ii], perm_idx[ii], ideal_aer)
+            for ii in range(num_circ))                        # evaluate all circuits; results keep circuit order
+    for ii, (qc, A, ev_ideal) in enumerate(samples):          # unpack list of (qc, A, ev_ideal)
+        qc_arr[ii], A_arr[ii], eval_ideal_arr[ii] = qc, A, ev_ideal
+
+#==== Submit all noisy simulations as a single job ===========#
+if not dk_analytic:                                           # noisy job runs in the background (non-blocking)
+    dk_job = noise_sim_submit(qc_arr, dk_model, dk_gates,
+                              sim_noise=dk_sim)               # simulate circs w/ depolarizing noise (density matrix)
+
+#==== Bin the ideal expectation values =======================#
+"""
+Aer runs the noisy job asynchronously, so the ideal expectation values are binned while it is still running.
+"""
+max_ev_ideal   = math.ceil(eval_ideal_arr.max())              # set maximum bin value as max array value, rounding up
+quant_ev_ideal = max_ev_ideal * 2                             # set number of bins as twice the max value (bins of 0.5 each)
+ev_ideal_freqs = np.zeros(quant_ev_ideal, dtype=np.int64)     # initialize array to store counts per bin of ideal exp. vals
+ev_ideal_freqs = bin_accumulate(eval_ideal_arr, 0, max_ev_ideal,
+                                ev_ideal_freqs)               # count number of expectation values found in each bin
+
+#==== Get noisy expectation values ===========================#
+eval_noise_arr = np.empty(num_circ, dtype=np.float64)         # preallocate array to store noisy evs
+if dk_analytic:                                               # closed form: skip the noisy simulator entirely
+    frac_A_arr = np.fromiter((np.mean(A) for A in A_arr), dtype=np.float64, count=num_circ)
+    eval_noise_arr[:] = calc_global_dk_eval(eval_ideal_arr, n, d, epsilon,
+                                            frac_A_arr)       # approximate noisy evs of A as global depolarizing noise
+else:
+    eval_noise_arr[:] = noise_sim_collect(dk_job, A_arr)      # wait for noisy simulations; get evs of A
+
+delta_zero_arr = calc_delta_zero(eval_ideal_arr, eval_noise_arr)  # find delta_0 for every random circuit at once
+for ii in range(num_circ):                                    # for each circuit
+    print("delta_0 ", ii, " is: ", delta_zero_arr[ii])        # print delta_0 value 
 
 #==== Bin the delta_zero values ==============================#
 categorical_dz = pd.cut(delta_zero_arr, bins)                 # cut data into categorical object based on bins
@@ -144,34 +165,83 @@ print("categorical dz is: ", categorical_dz)                  # print categorica
 dz_val_counts  = pd.value_counts(categorical_dz)              # get counts within each bin from the categorical object
 print("dz val counts is: ",  dz_val_counts)                   # print counts of delta_0 in each bin
 
-#==== Print initial ideal, ideal, & noisy expect. values =====#
-print("Initial ideal expectation values are:",eval_init_arr )
+#==== Print ideal & noisy expectation values =================#
 print("Ideal expectation values are:",        eval_ideal_arr)
 print("Noisy expectation values are:",        eval_noise_arr)
 
+print(ev_ideal_freqs)                                         # print ideal expectation value frequencies
 
-#==== Bin the initially calculated expectation values ========#
-max_ev_init    = math.ceil(max(eval_init_arr))                # set maximum bin value as max array value, rounding up
-quant_ev_init  = max_ev_init * 2                              # set number of bins as twice the max value (bins of 0.5 each)
-ev_init_bins   = create_bins(0,max_ev_init,quant_ev_init)     # create bins with given parameters
-binned_ev_init = []                                           # initialize array to store bin indexes of init exp. vals
-for ii in range(len(eval_init_arr)):                          # for expectation val in arr of initially calculated expectation vals
-    bin_index  = find_bin(eval_init_arr[ii], ev_init_bins)    # get index of bin for expectation value
-    binned_ev_init.append(bin_index)                          # append bin index of expectation val to array 
-ev_init_freqs  = Counter(binned_ev_init)                      # count number of times that each bin is found in array
-print(ev_init_freqs)                                          # print initial expectation value frequencies
+#==== Estimate ideal expectation values with PEC =============#
+"""
+For every circuit, M Pauli-corrected copies are sampled (see sample_pec_frames) and all of them are
+simulated with depolarizing noise as a single job; the signed noisy evs are then averaged and scaled by gamma_pec.
+With pec_numba, each sample is instead one sampled noise trajectory, evolved by the compiled pec_trials_core;
+the samples are independent, so the samples of all circuits are split into chunks of pec_batch, evaluated by
+one pool of parallel worker processes, and regrouped per circuit before aggregating.
+The frames are all drawn up front from the seeded RNG, so results don't depend on the worker scheduling.
+"""
+eval_pec_arr = np.empty(num_circ, dtype=np.float64)           # preallocate array to store PEC estimates
+gate_mats    = get_gate_mats(gate_list).astype(pec_dtype)     # unitaries of the single-qubit gates (for pec_numba)
+if run_pec and pec_numba:
+    pec_draws = [None] * num_circ                             # init. list to store (frames, signs, errs) of every circuit
+    for ii in range(num_circ):                                # draw per circuit in order (corrections, then errors)
+        frames, signs = sample_pec_frames(M, n, d, epsilon, perm_idx[ii],
+                                          seed=rng)           # draw Pauli corrections of all M samples at once
+        errs          = sample_dk_frames(M, n, d, epsilon, perm_idx[ii],
+                                         seed=rng)            # draw depolarizing errors of all M trajectories
+        pec_draws[ii] = (frames, signs, errs)
+    tasks = [(ii, a) for ii in range(num_circ) for a in range(0, M, pec_batch)]  # (circuit, first sample) of every chunk
+    with parallel_backend('loky', inner_max_num_threads=1):
+        parts = Parallel(n_jobs=n_jobs)(
+            delayed(pec_trials_core)(n, d, gate_mats, gate_idx[ii], perm_idx[ii],
+                                     pec_draws[ii][2][a:a+pec_batch], pec_draws[ii][0][a:a+pec_batch], A_arr[ii],
+                                     np.empty(1 << n, dtype=pec_dtype))
+            for ii, a in tasks)                               # evolve chunks of all circuits in one parallel call (compiled)
+    chunks_per_circ = len(range(0, M, pec_batch))             # number of chunks of every circuit (tasks are in circuit order)
+    for ii in range(num_circ):                                # regroup chunks per circuit
+        evals_pec = np.concatenate(parts[ii*chunks_per_circ:(ii+1)*chunks_per_circ])  # evs of all samples, in sample order
+        eval_pec_arr[ii] = aggregate_pec(pec_draws[ii][1], evals_pec.astype(np.float64),
+                                         gamma_pec)           # get PEC estimate of ideal ev
+elif run_pec:
+    for ii in range(num_circ):                                # for each circuit
+        frames, signs = sample_pec_frames(M, n, d, epsilon, perm_idx[ii],
+                                          seed=rng)           # draw Pauli corrections of all M samples at once
+        g_ii    = gate_idx[ii].tolist()                       # convert choices shared by all samples once
+        p_ii    = perm_idx[ii].tolist()
+        f_ii    = frames.tolist()                             # convert all M frames in one call
+        qcs_pec = [None] * M                                  # init. list to store sampled circuits
+        for m in range(M):
+            qcs_pec[m] = get_qc_ub(n, d, gate_list, gate_idx=g_ii, perm_idx=p_ii,
+                                   paulis=paulis, pauli_frame=f_ii[m])  # create circuit w/ sampled Pauli corrections
+            qcs_pec[m].save_density_matrix()                  # add save density matrix checkpoint to end of qc
+        evals_pec = noise_sim_batch(qcs_pec, [A_arr[ii]] * M, dk_model, dk_gates,
+                                    sim_noise=dk_sim)         # simulate all samples w/ depolarizing noise in one job
+        eval_pec_arr[ii] = aggregate_pec(signs, np.asarray(evals_pec, dtype=np.float64),
+                                         gamma_pec)           # get PEC estimate of ideal ev
+if run_pec:
+    delta_pec_arr = calc_delta_zero(eval_ideal_arr, eval_pec_arr)  # find error of PEC estimate for every circuit
+    print("PEC estimates are:",                   eval_pec_arr)
+    print("PEC errors are:",                      delta_pec_arr)
     
     
 
 
-fig, ax = plt.subplots()
+#==== Draw (only if requested) ===============================#
+"""
+Drawing needs matplotlib, which is slow to import and render, so it is skipped unless PEC_DRAW=1 is set.
+"""
+if draw:
+    import matplotlib.pyplot as plt                           # import matplotlib only when drawing
+    get_qc_ub(n, d, gate_list, drawstyle='mpl', filename='qc_0',
+              gate_idx=gate_idx[0], perm_idx=perm_idx[0])     # save diagram of first random circuit
+    fig, ax = plt.subplots()
 
 
 
 
 """
 To do:
-    Build estimator for ideal expectation values 
+    Plot binned delta_0 and PEC errors 
 """
 
 